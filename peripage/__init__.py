@@ -22,14 +22,203 @@ __license__ = 'GPLv3'
 __copyright__ = 'Copyright (c) GPLv3 2021-2023 bitrate16 (pegasko)'
 
 
+import re
 import time
-import qrcode
+import errno
+import queue
+import socket
+import threading
+import functools
 import typing
+import itertools
+import contextlib
 import enum
-import bluetooth
 
 import PIL.Image
-import PIL.ImageOps
+import PIL.ImageChops
+
+
+# Bytes that are not safe to send to the printer in ASCII mode. Everything
+# except `\n` and printable `0x20..0x7e` is removed with `bytes.translate()`
+_ASCII_UNSAFE = bytes(b for b in range(256) if not (31 < b < 127 or b == 10))
+
+# Matches any character that is not safe to send in ASCII mode, including all
+# non-ascii characters
+_ASCII_UNSAFE_RE = re.compile(r'[^\n\x20-\x7e]')
+
+# Grayscale to printer bit lookup table. Dark pixels (`< 128`) map to a set
+# bit which makes the printer burn a dot, so inversion and thresholding are
+# done in a single `Image.point()` pass
+_THRESHOLD_LUT = [ 255 if i < 128 else 0 for i in range(256) ]
+
+# Grayscale inversion lookup table, used before error-diffusion dithering
+_INVERT_LUT = [ 255 - i for i in range(256) ]
+
+# Any non-zero value to set bit lookup table
+_NONZERO_LUT = [ 0 ] + [ 255 ] * 255
+
+
+def _bayer_matrix(size: int) -> typing.List[typing.List[int]]:
+    """
+    Build ordered dithering matrix of `size x size`, `size` is power of two
+    """
+
+    if size == 1:
+        return [ [ 0 ] ]
+
+    m = _bayer_matrix(size // 2)
+    return [ [ 4 * v for v in row ] + [ 4 * v + 2 for v in row ] for row in m ] + \
+           [ [ 4 * v + 3 for v in row ] + [ 4 * v + 1 for v in row ] for row in m ]
+
+# Rows of 8x8 ordered dithering thresholds in grayscale range
+_BAYER_ROWS = [ bytes((v * 256 + 128) // 64 for v in row) for row in _bayer_matrix(8) ]
+
+
+def _bayer_dither(img: PIL.Image.Image) -> PIL.Image.Image:
+    """
+    Convert 'L' image to printer '1' image with 8x8 ordered dithering. Pixel
+    is black if it is darker than the tiled threshold, thresholds image is
+    built by repeating bytes and comparison is done with
+    `ImageChops.subtract()`, so each row is processed independently in C.
+    """
+
+    width, height = img.size
+    repeat = width // 8 + 1
+    block = b''.join((row * repeat)[:width] for row in _BAYER_ROWS)
+    pattern = (block * (height // 8 + 1))[:width * height]
+
+    threshold = PIL.Image.frombytes('L', img.size, pattern)
+    return PIL.ImageChops.subtract(threshold, img).point(_NONZERO_LUT, '1')
+
+# QR module to grayscale lookup table, dark module `1` is black
+_QR_MODULE_LUT = bytes([ 255, 0 ]) + bytes(254)
+
+# Requested socket send buffer size, kernel may clamp it
+_SOCKET_SNDBUF = 1 << 20
+
+# Printer opcodes, parsed once on import
+_CMD_GET_IP = bytes.fromhex('10ff20f0')
+_CMD_GET_NAME = bytes.fromhex('10ff3011')
+_CMD_GET_SERIAL_NUMBER = bytes.fromhex('10ff20f2')
+_CMD_GET_FIRMWARE = bytes.fromhex('10ff20f1')
+_CMD_GET_BATTERY = bytes.fromhex('10ff50f1')
+_CMD_GET_HARDWARE = bytes.fromhex('10ff3010')
+_CMD_GET_MAC = bytes.fromhex('10ff3012')
+_CMD_GET_FULL = bytes.fromhex('10ff70f100')
+_CMD_SET_SERIAL_NUMBER = bytes.fromhex('10ff20f4')
+_CMD_SET_POWER_TIMEOUT = bytes.fromhex('10ff12')
+_CMD_SET_CONCENTRATION = (
+    bytes.fromhex('10ff100000'),
+    bytes.fromhex('10ff100001'),
+    bytes.fromhex('10ff100002'),
+)
+_CMD_RESET = bytes.fromhex('10fffe01000000000000000000000000')
+_CMD_BREAK = bytes.fromhex('1b4a')
+_CMD_RASTER = bytes.fromhex('1d763000')
+
+# Line of spaces only in `Printer.printASCII()`, printed as break
+_BLANK_LINE_RE = re.compile(rb'^ *\n', re.MULTILINE)
+
+# Break that replaces an empty line in `Printer.printASCII()`
+_CMD_BREAK_LINE = _CMD_BREAK + bytes((30,))
+
+
+@functools.lru_cache(maxsize=64)
+def _make_qr(text: str, border: int=0) -> PIL.Image.Image:
+    """
+    Generate QR code image for the given text. Generation is slow for long
+    texts, so images are cached for repeated prints. Returned image is shared
+    between calls and must not be modified.
+
+    Uses `segno` if it is installed, it is much faster than `qrcode`. The
+    module matrix is converted to the image directly, one pixel per module.
+    QR libraries are imported on first use to keep import of this module fast.
+    """
+
+    try:
+        import segno
+    except ImportError:
+        segno = None
+
+    if segno is not None:
+        # Error correction level is not boosted, so code matches the `qrcode`
+        # fallback for the same text
+        qr = segno.make_qr(text, error='m', boost_error=False)
+        data = b''.join(bytes(row) for row in qr.matrix_iter(border=border))
+        return PIL.Image.frombytes('L', qr.symbol_size(border=border), data.translate(_QR_MODULE_LUT))
+
+    # Same conversion for qrcode module matrix, without rendering of boxed
+    # image by qrcode
+    import qrcode
+    qr = qrcode.QRCode(border=border)
+    qr.add_data(text)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    data = bytes(itertools.chain.from_iterable(matrix))
+    return PIL.Image.frombytes('L', (len(matrix), len(matrix)), data.translate(_QR_MODULE_LUT))
+
+
+def _isTimeout(e: OSError) -> bool:
+    """
+    Check if socket error is a timeout or would-block error of non-blocking
+    read rather than connection loss. PyBluez raises timeouts as
+    `BluetoothError('timed out')` instead of `socket.timeout`.
+    """
+
+    if isinstance(e, (socket.timeout, BlockingIOError)):
+        return True
+
+    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return True
+
+    message = str(e)
+    return 'timed out' in message or 'temporarily unavailable' in message
+
+
+def _prefetch(iterable: typing.Iterable, size: int) -> typing.Iterator:
+    """
+    Iterate over `iterable` in background thread, keeping up to `size` items
+    ready. Lets slow generators produce next items while printer is busy.
+    Exception raised by `iterable` is re-raised in the consuming thread. If
+    consumer stops early, background thread stops after the current item once
+    returned generator is closed.
+    """
+
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry) -> bool:
+        # Retry until consumer takes the item or stops consuming
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
 
 
 class PrinterTypeSpecs:
@@ -113,7 +302,7 @@ class Printer:
         in most internal calls.
         """
 
-        return ''.join([ i for i in text if (31 < ord(i) or ord(i) == 10) and ord(i) < 127 ])
+        return text.encode('ascii', 'ignore').translate(None, _ASCII_UNSAFE).decode('ascii')
 
     @staticmethod
     def is_safe_ascii(text: str) -> bool:
@@ -121,10 +310,7 @@ class Printer:
         Check is string does not contain non-safe-ascii letters (like `>0x7f` or `\\0`).
         """
 
-        for i in text:
-            if (31 < ord(i) or ord(i) == 10) and ord(i) < 127:
-                return False
-        return True
+        return _ASCII_UNSAFE_RE.search(text) is None
 
     def __init__(self, mac: str, printer_type: PrinterType, timeout: float=1.0):
         """
@@ -145,18 +331,72 @@ class Printer:
         self.timeout = timeout
         self.printer_type = printer_type
 
-        # buffer used for continuous printing with line wrapping
-        self.print_buffer = ''
+        # Printer specs are read inside of printing loops, cache them
+        self._row_bytes = printer_type.spec.row_bytes
+        self._row_width = printer_type.spec.row_width
+        self._row_characters = printer_type.spec.row_characters
+
+        # Raster request headers for each chunk height, width in bytes and
+        # height are 16-bit little endian `xL xH yL yH`
+        prefix = _CMD_RASTER + int.to_bytes(self._row_bytes, 2, 'little')
+        self._raster_headers = [ prefix + int.to_bytes(height, 2, 'little') for height in range(0x100) ]
+
+        # Matches full row of characters followed by the rest of the line
+        self._wrap_re = re.compile(rb'[^\n\0]{%d}(?=[^\n\0])' % self._row_characters)
+
+        # buffer used for continuous printing with line wrapping, kept as
+        # filtered ascii bytes, exposed as `Printer.print_buffer` string
+        self._print_buffer = b''
+
+        # Requests and delays collected inside of `Printer.batched()`
+        self._batch = None
+        self._batch_delay = 0.0
+
+        # Number of acknowledgements not yet read inside of
+        # `Printer.pipeline()`, `None` outside of it
+        self._pending_acks = None
+
+        # Monotonic time when the last write started, print delays are
+        # counted from it, so time spent on sending is not waited twice
+        self._sent_at = 0.0
+
+        # Connection state, tracked by connect()/reconnect()/disconnect()
+        self._connected = False
+
+        # Printer state must be reset before next raster print, set after
+        # connecting, after setters, ASCII text and breaks and after aborted
+        # batch. Raw `tellPrinter()` output is not tracked, use `force_reset`
+        self._needs_reset = True
+
+    @property
+    def print_buffer(self) -> str:
+        """
+        Incomplete row of text printed by `Printer.printASCII()` that is not
+        yet sent to the printer.
+        """
+
+        return self._print_buffer.decode('ascii')
+
+    @print_buffer.setter
+    def print_buffer(self, text: str) -> None:
+        self._print_buffer = Printer.filter_ascii(text).encode('ascii')
 
-    def isConnected(self) -> bool:
+    def isConnected(self, check: bool=False) -> bool:
         """
-        Check if printer is connected (socket alive)
+        Check if printer is connected. By default returns the connection state
+        tracked by `connect()`, `reconnect()` and `disconnect()`.
+
+        Arguments:
+        * `check` - additionally probe the socket to be alive
         """
 
+        if not check or not self._connected:
+            return self._connected
+
         try:
             self.sock.getpeername()
             return True
-        except:
+        except OSError:
             return False
 
     def connect(self) -> None:
@@ -169,9 +409,23 @@ class Printer:
         `reset()` after connecting.
         """
 
+        # PyBluez is loaded on first connection, so importing the module for
+        # image conversion or inspection does not require bluetooth stack
+        import bluetooth
+
         self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+
+        # Larger send buffer lets kernel fill full RFCOMM frames from large
+        # image chunks, not supported on every platform
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_SNDBUF)
+        except OSError:
+            pass
+
         self.sock.connect((self.mac, 1))
         self.sock.settimeout(self.timeout)
+        self._connected = True
+        self._needs_reset = True
 
     def reconnect(self) -> None:
         """
@@ -181,25 +435,43 @@ class Printer:
         `reset()` after connecting.
         """
 
-        if self.isConnected():
-            # self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
-            del self.sock
-
-        self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        self.sock.connect((self.mac, 1))
-        self.sock.settimeout(self.timeout)
+        self._closeSocket()
+        self.connect()
 
     def disconnect(self) -> None:
         """
         Disconnect from the printer.
         """
 
-        if self.isConnected():
+        self._closeSocket()
+        self._needs_reset = True
+
+    def _closeSocket(self) -> None:
+        """
+        Close existing socket. Socket is closed even if connection was already
+        marked as lost by socket error, so descriptor is not leaked.
+        """
+
+        sock = getattr(self, 'sock', None)
+        self._connected = False
+        if sock is not None:
             # self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
+            sock.close()
             del self.sock
 
+    def __enter__(self) -> 'Printer':
+        """
+        Connect to the printer and perform `reset()`, connection is closed on
+        exit from the `with` block.
+        """
+
+        self.connect()
+        self.reset()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.disconnect()
+
     def setTimeout(self, timeout) -> None:
         """
         Set the bluetooth socket connection recv / send timeout.
@@ -209,15 +481,197 @@ class Printer:
         if self.isConnected():
             self.sock.settimeout(timeout)
 
+    def _socketError(self, e: OSError) -> None:
+        """
+        Track connection state on socket error, any error except timeout
+        means that connection is lost.
+        """
+
+        if not _isTimeout(e):
+            self._connected = False
+
+    def _wait(self, seconds: float) -> None:
+        """
+        Wait for printer to process sent data. Delay is counted from the start
+        of the last write, so only the remaining time is slept. Inside of
+        `Printer.batched()` delay is postponed until the batch is sent.
+        """
+
+        if self._batch is not None:
+            self._batch_delay += seconds
+            return
+
+        remaining = self._sent_at + seconds - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    @contextlib.contextmanager
+    def batched(self):
+        """
+        Collect all requests sent without response inside of the `with` block
+        and send them with a single write on exit, followed by the total delay
+        of all collected requests. Requests with response flush the collected
+        data first to keep the order. On exception collected data is dropped.
+
+        Example:
+        ```
+        with printer.batched():
+            printer.printlnASCII('Hello')
+            printer.printBreak(30)
+        ```
+        """
+
+        # Nested batch is a part of the outer one
+        if self._batch is not None:
+            yield self
+            return
+
+        self._batch = bytearray()
+        self._batch_delay = 0.0
+        try:
+            yield self
+        except:
+            # Dropped data may contain reset, it was never sent
+            self._batch = None
+            self._needs_reset = True
+            raise
+
+        self.flushBatch()
+        self._batch = None
+
+    def flushBatch(self) -> None:
+        """
+        Send data collected inside of `Printer.batched()` and wait for the
+        collected delay. Does nothing outside of batch.
+        """
+
+        if self._batch is None or len(self._batch) == 0:
+            return
+
+        data, delay = self._batch, self._batch_delay
+        self._batch = bytearray()
+        self._batch_delay = 0.0
+
+        self._sent_at = time.monotonic()
+        try:
+            self._sendall(data)
+        except OSError as e:
+            self._socketError(e)
+            raise
+
+        remaining = self._sent_at + delay - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """
+        Defer reading acknowledgements of setters called with `wait=True`
+        inside of the `with` block. Requests are sent immediately and all
+        acknowledgements are read on exit or before the next request that
+        expects a response, so the setters do not wait for a round-trip each.
+        Setters return `None` instead of the response inside of the block.
+
+        Example:
+        ```
+        with printer.pipeline():
+            printer.setPowerTimeout(30)
+            printer.setConcentration(2, wait=True)
+            printer.printASCII('Hello\n')
+        ```
+        """
+
+        # Nested pipeline is a part of the outer one
+        if self._pending_acks is not None:
+            yield self
+            return
+
+        self._pending_acks = 0
+        try:
+            yield self
+            self._drainAcks()
+        finally:
+            self._pending_acks = None
+
+    def _acknowledge(self, request: bytes) -> bytes:
+        """
+        Send request which response is only an acknowledgement. Inside of
+        `Printer.pipeline()` response is read later and `None` is returned.
+        """
+
+        if self._pending_acks is None:
+            return self.askPrinter(request)
+
+        self.tellPrinter(request)
+        self._pending_acks += 1
+
+    def _drainAcks(self) -> None:
+        """
+        Read acknowledgements deferred by `Printer.pipeline()`, so they are
+        not mistaken for the response of the next request. First
+        acknowledgement is waited for, the rest may arrive merged into a
+        single read, so they are read without blocking until none is left.
+        """
+
+        if not self._pending_acks:
+            return
+
+        self.flushBatch()
+
+        pending = self._pending_acks
+        self._pending_acks = 0
+
+        try:
+            self.sock.recv(1024)
+
+            self.sock.settimeout(0)
+            try:
+                for _ in range(pending - 1):
+                    self.sock.recv(1024)
+            finally:
+                self.sock.settimeout(self.timeout)
+        except OSError as e:
+            if _isTimeout(e):
+                return
+            self._socketError(e)
+            raise
+
+    def _sendall(self, data: bytes) -> None:
+        """
+        Write whole `data` to the socket. Not every `BluetoothSocket`
+        implementation provides `sendall()`, partial writes of `send()` are
+        continued from a `memoryview` without copying the rest of the data.
+        """
+
+        sendall = getattr(self.sock, 'sendall', None)
+        if sendall is not None:
+            sendall(data)
+            return
+
+        view = memoryview(data)
+        while len(view) != 0:
+            view = view[self.sock.send(view):]
+
     def tellPrinter(self, byteseq: bytes) -> None:
         """
-        Send `bytes` to the printer without response.
+        Send `bytes` to the printer without response. Whole sequence is
+        written to the socket, even if it does not fit a single packet.
+        Inside of `Printer.batched()` data is collected and sent on exit.
 
         Arguments:
         * `byteseq` - `bytes` data
         """
 
-        self.sock.send(byteseq)
+        if self._batch is not None:
+            self._batch += byteseq
+            return
+
+        self._sent_at = time.monotonic()
+        try:
+            self._sendall(byteseq)
+        except OSError as e:
+            self._socketError(e)
+            raise
 
     def askPrinter(self, byteseq: bytes, recv_size: int=1024) -> bytes:
         """
@@ -228,8 +682,15 @@ class Printer:
         * `byteseq` - `bytes` data
         """
 
-        self.sock.send(byteseq)
-        return self.sock.recv(recv_size)
+        self.flushBatch()
+        self._drainAcks()
+
+        try:
+            self._sendall(byteseq)
+            return self.sock.recv(recv_size)
+        except OSError as e:
+            self._socketError(e)
+            raise
 
     def listenPrinter(self, recv_size: int=1024) -> bytes:
         """
@@ -239,31 +700,46 @@ class Printer:
         * `recv_size` - max size of received chunk
         """
 
-        return self.sock.recv(recv_size)
+        self.flushBatch()
+        self._drainAcks()
+
+        try:
+            return self.sock.recv(recv_size)
+        except OSError as e:
+            self._socketError(e)
+            raise
 
     def tellPrinterSeq(self, byteseq: typing.Iterable[bytes]) -> None:
         """
-        Send list of `bytes` to the printer without response.
+        Send list of `bytes` to the printer without response. Sequence is
+        joined and sent with a single write, use `Printer.tellPrinter()` for
+        each item if printer requires delay between them.
 
         Arguments:
         * `byteseq` - `list` of `bytes`
         """
 
-        for s in byteseq:
-            self.sock.send(s)
+        self.tellPrinter(b''.join(byteseq))
 
     def askPrinterSeq(self, byteseq: typing.Iterable[bytes], recv_size: int=1024) -> bytes:
         """
-        Send list of `bytes` to the printer with response.
+        Send list of `bytes` to the printer with response. Sequence is joined
+        and sent with a single write.
 
         Arguments:
         * `recv_size` - max size of received chunk
         * `byteseq` - `list` of `bytes`
         """
 
-        for s in byteseq:
-            self.sock.send(s)
-        return self.sock.recv(recv_size)
+        self.flushBatch()
+        self._drainAcks()
+
+        try:
+            self._sendall(b''.join(byteseq))
+            return self.sock.recv(recv_size)
+        except OSError as e:
+            self._socketError(e)
+            raise
 
     def getDeviceIP(self) -> bytes:
         """
@@ -276,7 +752,7 @@ class Printer:
         Example: Peripage A6+ returns `IP-300`.
         """
 
-        return self.askPrinter(bytes.fromhex('10ff20f0'))
+        return self.askPrinter(_CMD_GET_IP)
 
     def getDeviceName(self) -> bytes:
         """
@@ -289,7 +765,7 @@ class Printer:
         Example: Peripage A6+ returns `PeriPage+DF7A`.
         """
 
-        return self.askPrinter(bytes.fromhex('10ff3011'))
+        return self.askPrinter(_CMD_GET_NAME)
 
     def getDeviceSerialNumber(self) -> bytes:
         """
@@ -302,7 +778,7 @@ class Printer:
         Example: Peripage A6+ returns `A6491571121`.
         """
 
-        return self.askPrinter(bytes.fromhex('10ff20f2'))
+        return self.askPrinter(_CMD_GET_SERIAL_NUMBER)
 
     def getDeviceFirmware(self) -> bytes:
         """
@@ -315,7 +791,7 @@ class Printer:
         Example: Peripage A6+ returns `V2.11_304dpi`.
         """
 
-        return self.askPrinter(bytes.fromhex('10ff20f1'))
+        return self.askPrinter(_CMD_GET_FIRMWARE)
 
     def getDeviceBattery(self) -> int:
         """
@@ -327,7 +803,7 @@ class Printer:
 
         Example: Peripage A6+ returns `\\x00@` (equals to `bytes[2] = { 0, 64 }`).
         """
-        return int(self.askPrinter(bytes.fromhex('10ff50f1'))[1])
+        return int(self.askPrinter(_CMD_GET_BATTERY)[1])
 
     def getDeviceHardware(self) -> bytes:
         """
@@ -341,7 +817,7 @@ class Printer:
         `BR2141e-s` chip with a pile of ascii letters.
         """
 
-        return self.askPrinter(bytes.fromhex('10ff3010'))
+        return self.askPrinter(_CMD_GET_HARDWARE)
 
     def getDeviceMAC(self) -> bytes:
         """
@@ -355,7 +831,7 @@ class Printer:
         (equals to `00:F5:73:25:AC:9F`).
         """
 
-        return self.askPrinter(bytes.fromhex('10ff3012'))
+        return self.askPrinter(_CMD_GET_MAC)
 
     def getDeviceFull(self) -> bytes:
         """
@@ -375,7 +851,7 @@ class Printer:
         in-printer ASCII buffer.
         """
 
-        return self.askPrinter(bytes.fromhex('10ff70f100'))
+        return self.askPrinter(_CMD_GET_FULL)
 
     def getRowBytes(self) -> int:
         """
@@ -386,7 +862,7 @@ class Printer:
         limit per image row, the overflow is truncated.
         """
 
-        return self.printer_type.spec.row_bytes
+        return self._row_bytes
 
     def getRowWidth(self) -> int:
         """
@@ -397,7 +873,7 @@ class Printer:
         limit per image row, the overflow is truncated.
         """
 
-        return self.printer_type.spec.row_width
+        return self._row_width
 
     def getRowCharacters(self) -> int:
         """
@@ -410,7 +886,7 @@ class Printer:
         with the in-printer buffer.
         """
 
-        return self.printer_type.spec.row_characters
+        return self._row_characters
 
     def getHeightLimit(self) -> int:
         """
@@ -441,10 +917,11 @@ class Printer:
         `Printer.is_safe_ascii()` check.
         """
 
-        request = bytes.fromhex('10ff20f4') + Printer.filter_ascii(serial_number).encode('ascii') + b'\0'
+        request = _CMD_SET_SERIAL_NUMBER + Printer.filter_ascii(serial_number).encode('ascii') + b'\0'
+        self._needs_reset = True
 
         if wait:
-            return self.askPrinter(request)
+            return self._acknowledge(request)
         else:
             self.tellPrinter(request)
 
@@ -464,10 +941,11 @@ class Printer:
         """
 
         timeout = max(min(0xfff0, timeout), 0x0001)
-        request = bytes.fromhex('10ff12') + int.to_bytes(timeout, 2, 'big')
+        request = _CMD_SET_POWER_TIMEOUT + int.to_bytes(timeout, 2, 'big')
+        self._needs_reset = True
 
         if wait:
-            return self.askPrinter(request)
+            return self._acknowledge(request)
         else:
             self.tellPrinter(request)
 
@@ -485,15 +963,11 @@ class Printer:
         * `concentration` - concentration value from range `(0, 1, 2)`
         """
 
-        if concentration <= 0:
-            request = bytes.fromhex('10ff100000')
-        elif concentration == 1:
-            request = bytes.fromhex('10ff100001')
-        elif concentration >= 2:
-            request = bytes.fromhex('10ff100002')
+        request = _CMD_SET_CONCENTRATION[min(max(concentration, 0), 2)]
+        self._needs_reset = True
 
         if wait:
-            return self.askPrinter(request)
+            return self._acknowledge(request)
         else:
             self.tellPrinter(request)
 
@@ -506,7 +980,8 @@ class Printer:
         Request: `10fffe01+000000000000000000000000`.
         """
 
-        self.tellPrinter(bytes.fromhex('10fffe01000000000000000000000000'))
+        self.tellPrinter(_CMD_RESET)
+        self._needs_reset = False
 
     def printBreak(self, size: int=0x40) -> None:
         """
@@ -522,11 +997,12 @@ class Printer:
         """
 
         size = min(0xff, max(0x01, size))
-        request = bytes.fromhex('1b4a') + int.to_bytes(size, 1, 'big')
+        request = _CMD_BREAK + bytes((size,))
+        self._needs_reset = True
 
         self.tellPrinter(request)
 
-    def writeASCII(self, text: str='\n', wait=False) -> None:
+    def writeASCII(self, text: typing.Union[str, bytes]='\n', wait=False) -> None:
         """
         WARNING: THIS API IS UNSAFE
 
@@ -542,13 +1018,15 @@ class Printer:
         Arguments:
         * `text` - text to be printed, should be checked by user before print or
         may malfunction and/or damage the printer. String must not contain
-        repeating `\\n` characters or printer will freeze.
+        repeating `\\n` characters or printer will freeze. Already encoded
+        `bytes` are sent as is.
         """
 
-        request = text.encode('ascii')
+        request = text.encode('ascii') if isinstance(text, str) else text
+        self._needs_reset = True
 
         if wait:
-            return self.askPrinter(request)
+            return self._acknowledge(request)
         else:
             self.tellPrinter(request)
 
@@ -572,7 +1050,7 @@ class Printer:
 
         self.printASCII(text=text + '\n', delay=delay)
 
-    def printASCII(self, text: str='\n', delay: float=0.25) -> None:
+    def printASCII(self, text: typing.Union[str, bytes]='\n', delay: float=0.25) -> None:
         """
         Safe to use printing method that relies on in-class buffer for wrapping
         text. The input is filtered with `Printer.filter_ascii` in order to
@@ -585,72 +1063,53 @@ class Printer:
         In case when the input text contains two sequential `\\n`, they are
         replaced with `Printer.printBreak(30)`.
 
+        All complete rows are wrapped and sent to printer as a single request,
+        incomplete trailing row is kept in buffer until the next call.
+
         Request: `impl:Printer.writeASCII()`.
 
         Arguments:
         * `text` - text to be printed, automatically filtered with
-        `Printer.filter_ascii()` and splitted into newline-chunked data.
-        * `delay` - delay between lines submission, seconds
+        `Printer.filter_ascii()` and splitted into newline-chunked data. Raw
+        `bytes` are filtered the same way without unicode decoding.
+        * `delay` - delay per each printed row, seconds
         """
 
-        text = Printer.filter_ascii(text)
-
-        # Check for empty and print out newline
-        text = self.print_buffer + text
-        self.print_buffer = ''
+        # Text is wrapped as filtered ascii bytes, without decoding back
+        if isinstance(text, str):
+            text = text.encode('ascii', 'ignore')
+        text = self._print_buffer + text.translate(None, _ASCII_UNSAFE)
+        self._print_buffer = b''
         if len(text) == 0:
             return
 
-        # Special case: \n only, causes duplicating newlines (white-only string)
-        if len(text.strip()) == 0:
-            for s in text:
-                if s == '\n':
-                    self.printBreak(30)
-                    time.sleep(delay)
-            return
-
-        # Iterlines
-        lines = text.split('\n')
-        for l in lines:
-
-            # Flush previuos incomplete line
-            if len(self.print_buffer) != 0:
-                self.tellPrinter(self.print_buffer.encode('ascii'))
-                self.tellPrinter(b'\n')
-                self.print_buffer = ''
-                time.sleep(delay)
-
-            # Flush if white-empty, because it is newline
-            elif len(l.strip()) == 0:
-
-                # Flush in-printer buffer if not empty
-                if len(self.print_buffer) != 0:
-                    self.tellPrinter(self.print_buffer.encode('ascii'))
-                    self.tellPrinter(b'\n')
-                    self.print_buffer = ''
-                    time.sleep(delay)
-
-                # Trail
-                else:
-                    self.printBreak(30)
-                    time.sleep(delay)
-
-            # Process normal lines
-            else:
-                # Wrap line
-                parts = [ l[i:i+self.getRowCharacters()] for i in range(0, len(l), self.getRowCharacters()) ]
-
-                for p in parts:
-
-                    # Print full line
-                    if len(p) == self.getRowCharacters():
-                        self.tellPrinter(p.encode('ascii'))
-                        self.tellPrinter(b'\n')
-                        time.sleep(delay)
-
-                    # Partial, write to buffer
-                    else:
-                        self.print_buffer = p
+        # Complete lines are printed, incomplete trailing line is buffered
+        end = text.rfind(b'\n') + 1
+        body, last = text[:end], text[end:]
+
+        # White-empty line is a newline, replace with break. Break is marked
+        # with `\0` that never passes the filter, so wrapping skips it
+        body = _BLANK_LINE_RE.sub(b'\0', body)
+
+        # Last unterminated line: print full rows, keep the rest in buffer.
+        # Whitespace-only tail is kept whole, it may be indentation of the text
+        # received by the next call
+        if len(last) != 0:
+            full = len(last) - len(last) % self._row_characters if len(last.strip()) != 0 else 0
+            if full != 0:
+                body += last[:full] + b'\n'
+            if full != len(last):
+                self._print_buffer = last[full:]
+
+        # Wrap lines, each part is terminated with newline
+        body = self._wrap_re.sub(b'\\g<0>\n', body)
+        rows = body.count(b'\n') + body.count(b'\0')
+        request = body.replace(b'\0', _CMD_BREAK_LINE)
+
+        if rows != 0:
+            self.tellPrinter(request)
+            self._needs_reset = True
+            self._wait(delay * rows)
 
     def flushASCII(self, delay: float=0.25) -> None:
         """
@@ -664,13 +1123,17 @@ class Printer:
         * `delay` - delay between lines submission, seconds
         """
 
-        if len(self.print_buffer) != 0:
-            self.tellPrinter(self.print_buffer.encode('ascii'))
-            self.tellPrinter(b'\n')
-            self.print_buffer = ''
-            time.sleep(delay)
+        if len(self._print_buffer) != 0:
+            # White-empty line is a newline, printed as break
+            if len(self._print_buffer.strip()) == 0:
+                self.tellPrinter(_CMD_BREAK_LINE)
+            else:
+                self.tellPrinter(self._print_buffer + b'\n')
+            self._needs_reset = True
+            self._print_buffer = b''
+            self._wait(delay)
 
-    def printRow(self, rowbytes: bytes, delay: float=0.01) -> None:
+    def printRow(self, rowbytes: bytes, delay: float=0.01, force_reset: bool=False) -> None:
         """
         Send bytes representing a single image row in binary black/white mode.
         If amount of bydes exceedes the `Printer.getRowBytes()` constant, input
@@ -688,24 +1151,19 @@ class Printer:
         * `rowbytes` - bytes representing image pixels, 8 pixels per byte,
         truncated/padded to fit `Printer.getRowBytes()`.
         * `delay` - delay between printing each row of the image.
+        * `force_reset` - reset printer state even if it was not changed since
+        the last raster print.
         """
 
-        expectedLen = self.getRowBytes()
+        expectedLen = self._row_bytes
         if len(rowbytes) < expectedLen:
             rowbytes = rowbytes.ljust(expectedLen, b'\0')
         elif len(rowbytes) > expectedLen:
             rowbytes = rowbytes[:expectedLen]
 
-        self.reset()
+        self._printChunk(rowbytes, 1, delay=delay, force_reset=force_reset)
 
-        # Notify printer about incomming $expectedLen bytes row
-        request = bytes.fromhex('1d763000') + int.to_bytes(self.getRowBytes(), 1, 'big') + bytes.fromhex('000100') + rowbytes
-        self.tellPrinter(request)
-        time.sleep(delay)
-
-        # We're done here
-
-    def printRowBytesList(self, rowbytes: typing.Iterable[bytes], delay: float=0.01) -> None:
+    def printRowBytesList(self, rowbytes: typing.Iterable[bytes], delay: float=0.01, force_reset: bool=False) -> None:
         """
         Send an array of bytes representing a multiple image rows in binary
         black/white mode. If amount of bydes per row exceedes the
@@ -721,62 +1179,107 @@ class Printer:
         request, `0030` is big endian bytes per row, `0001` is big endian input
         height.
 
-        Request: chunked `1d763000+bytes[1]:big_endian+00+bytes[1]:big_endian+00+bytes[Printer.getRowBytes()*chunk_height]`.
+        Each chunk is sent with a single write, the delay is applied once per
+        chunk and is proportional to the chunk height. Printer is reset only if
+        its state was changed since the last raster print, the reset request
+        is sent in the same write as the first chunk.
+
+        Request: `[impl:Printer.reset()]` + chunked `1d763000+bytes[1]:big_endian+00+bytes[1]:big_endian+00+bytes[Printer.getRowBytes()*chunk_height]`.
 
         Arguments:
         * `rowbytes` - list of bytes defining each row of the image. If row
         length does not match the `Printer.getRowBytes()`, data is
         truncated/padded to match the size.
         * `delay` - delay between printing each row of the image.
+        * `force_reset` - reset printer state even if it was not changed since
+        the last raster print.
         """
 
         if len(rowbytes) == 0:
             return
 
-        expectedLen = self.getRowBytes()
-        chunks = [ rowbytes[i:i+0xff] for i in range(0, len(rowbytes), 0xff) ]
+        expectedLen = self._row_bytes
 
-        for chunk in chunks:
+        # Single buffer for the largest chunk is reused by all chunks
+        data = bytearray(min(len(rowbytes), 0xff) * expectedLen)
+        view = memoryview(data)
 
-            # Reset state before print
-            self.reset()
+        for i in range(0, len(rowbytes), 0xff):
+            chunk = rowbytes[i:i+0xff]
 
-            #                 1d763000    30                    00    01                     00
-            # Send preamble: `1d763000` + row_bytes:bytes[1] + `00` + chunk_size:bytes[1] + `00`
-            request = bytes.fromhex('1d763000') + int.to_bytes(self.getRowBytes(), 1, 'big') + bytes.fromhex('00') + int.to_bytes(len(chunk), 1, 'big') + bytes.fromhex('00')
+            # Short rows are padded with zeros, long rows are truncated
+            offset = 0
+            for row in chunk:
+                size = min(len(row), expectedLen)
+                view[offset:offset+size] = row[:size]
+                view[offset+size:offset+expectedLen] = bytes(expectedLen - size)
+                offset += expectedLen
 
-            # Flush preamble
-            self.tellPrinter(request)
+            self._printChunk(view[:offset], len(chunk), delay=delay, force_reset=force_reset)
+            force_reset = False
 
-            # Flush rows dith delay
-            for row in chunk:
-                # trunc/pad
-                if len(row) < expectedLen:
-                    row = row.ljust(expectedLen, b'\0')
-                elif len(row) > expectedLen:
-                    row = row[:expectedLen]
+    def _printChunk(self, data: bytes, height: int, delay: float=0.01, force_reset: bool=False) -> None:
+        """
+        Send a single image chunk of `height` rows of exactly
+        `Printer.getRowBytes()` bytes each. `data` can be any bytes-like object
+        (including `memoryview` slice). Preamble and rows are sent with a
+        single write, then waits for `delay` per row to let printer burn the
+        chunk. If printer state was changed since the last raster print or
+        `force_reset` is set, reset request is prepended to the same write.
+
+        Request: `[10fffe01+bytes[12]]+1d763000+bytes[2]:little_endian+bytes[2]:little_endian+data`.
+        """
 
-                self.tellPrinter(row)
+        #                 1d763000    3000                          0100
+        # Send preamble: `1d763000` + row_bytes:bytes[2]:little_endian + chunk_size:bytes[2]:little_endian
+        request = self._raster_headers[height]
 
-                time.sleep(delay)
+        # Reset state before print
+        if force_reset or self._needs_reset:
+            request = _CMD_RESET + request
+            self._needs_reset = False
 
-    def printRowBytesIterator(self, rowiterator: typing.Iterable[bytes], delay: float=0.01) -> None:
+        self.tellPrinter(request + data)
+        self._wait(delay * height)
+
+    def printRowBytesIterator(self, rowiterator: typing.Iterable[bytes], delay: float=0.01, prefetch: int=0) -> None:
         """
         Iterate over the given iterator and print out all produced rows. This
         method is very slow as it required printer to oftenly switch on/off
         printing mode and pass a large overhead to set up the printing mode.
 
-        This method uses the `Printer.printRow()` call.
+        Each row is printed as with the `Printer.printRow()` call.
 
         Arguments:
         * `rowiterator` - iterator that returns bytes.
         * `delay` - delay between printing each row of the image.
+        * `prefetch` - if positive, iterator is consumed in background thread
+        that keeps up to `prefetch` rows ready while printer is busy.
         """
 
+        if prefetch > 0:
+            with contextlib.closing(_prefetch(rowiterator, prefetch)) as rows:
+                self.printRowBytesIterator(rows, delay=delay)
+            return
+
+        # Rows are padded/truncated in a single reused buffer instead of
+        # allocating a new padded copy for each row
+        expectedLen = self._row_bytes
+        scratch = bytearray(expectedLen)
+        view = memoryview(scratch)
+
         for r in rowiterator:
-            self.printRow(r, delay=delay)
+            # Rows of exact size are sent as is
+            if len(r) == expectedLen:
+                self._printChunk(r, 1, delay=delay)
+                continue
+
+            size = min(len(r), expectedLen)
+            view[:size] = r[:size]
+            view[size:] = bytes(expectedLen - size)
+            self._printChunk(scratch, 1, delay=delay)
 
-    def printRowChunksIterator(self, rowiterator: typing.Iterable[typing.List[bytes]], delay: float=0.01) -> None:
+    def printRowChunksIterator(self, rowiterator: typing.Iterable[typing.List[bytes]], delay: float=0.01, prefetch: int=0) -> None:
         """
         Iterate over the given iterator and print out all produced chunks of
         rows. One chunk of rows is a list of bytes where each bytes define the
@@ -787,12 +1290,19 @@ class Printer:
         Arguments:
         * `rowiterator` - iterator that returns list[bytes].
         * `delay` - delay between printing each row of the image.
+        * `prefetch` - if positive, iterator is consumed in background thread
+        that keeps up to `prefetch` chunks ready while printer is busy.
         """
 
+        if prefetch > 0:
+            with contextlib.closing(_prefetch(rowiterator, prefetch)) as chunks:
+                self.printRowChunksIterator(chunks, delay=delay)
+            return
+
         for chunk in rowiterator:
             self.printRowBytesList(chunk, delay=delay)
 
-    def printImageBytes(self, imagebytes: bytes, delay: float=0.01) -> None:
+    def printImageBytes(self, imagebytes: bytes, delay: float=0.01, force_reset: bool=False) -> None:
         """
         Send an bytes representing single-line encoded image. For example,
         `[0xff000000, 0x00ff0000, 0x0000ff00, 0x000000ff]` is encoded as
@@ -809,18 +1319,92 @@ class Printer:
         properly. If length of the last row dows not match
         `Printer.getRowBytes()`, data is truncated/padded to match the size.
         * `delay` - delay between printing each row of the image.
+        * `force_reset` - reset printer state even if it was not changed since
+        the last raster print.
         """
 
         if len(imagebytes) == 0:
             return
 
-        # Delegate to impl
-        self.printRowBytesList([ imagebytes[i:i+self.getRowBytes()] for i in range(0, len(imagebytes), self.getRowBytes()) ], delay=delay)
+        rowBytes = self._row_bytes
+
+        # Pad partial last row
+        if len(imagebytes) % rowBytes != 0:
+            imagebytes = bytearray(imagebytes)
+            imagebytes += bytes(rowBytes - len(imagebytes) % rowBytes)
+
+        self._printRowsFromBuffer(memoryview(imagebytes), delay=delay, force_reset=force_reset)
 
-    def printImage(self, img: PIL.Image.Image, delay=0.01, resample=PIL.Image.Resampling.NEAREST) -> None:
+    def _printRowsFromBuffer(self, view: memoryview, delay: float=0.01, force_reset: bool=False) -> None:
+        """
+        Print rows stored in a contiguous buffer which length is a multiple of
+        `Printer.getRowBytes()`. Buffer is sent by chunks of `0xff` rows using
+        slices of `view` without copying.
+        """
+
+        rowBytes = self._row_bytes
+        height = len(view) // rowBytes
+
+        for y in range(0, height, 0xff):
+            chunkHeight = min(0xff, height - y)
+            start = y * rowBytes
+            self._printChunk(view[start:start+chunkHeight*rowBytes], chunkHeight, delay=delay, force_reset=force_reset)
+            force_reset = False
+
+    def _convertImage(self, img: PIL.Image.Image, resample, dither: str) -> PIL.Image.Image:
+        """
+        Convert image into '1' mode image of `Printer.getRowWidth()` width with
+        set bits for burned dots, which serializes into printer rows.
+        """
+
+        if dither not in (None, 'fs', 'bayer'):
+            raise ValueError(f'Unknown dither mode { dither }')
+
+        # Black/white image of the printer width only needs bit inversion
+        if img.mode == '1' and img.size[0] == self._row_width:
+            img = PIL.ImageChops.invert(img)
+
+        else:
+            # Grayscale conversion of an 'L' image is a full copy, skip it
+            if img.mode != 'L':
+                img = img.convert('L')
+
+            # Resize the single-channel image, thresholding follows on the
+            # smallest intermediate. Skip if image already fits the printer
+            if img.size[0] != self._row_width:
+                img = img.resize((self._row_width, img.size[1] * self._row_width // img.size[0]), resample)
+
+            if dither is None:
+                img = img.point(_THRESHOLD_LUT, '1')
+            elif dither == 'fs':
+                img = img.point(_INVERT_LUT).convert('1', dither=PIL.Image.Dither.FLOYDSTEINBERG)
+            else:
+                img = _bayer_dither(img)
+
+        return img
+
+    def encodeImage(self, img: PIL.Image.Image, resample=PIL.Image.Resampling.NEAREST, dither: str='fs') -> bytes:
+        """
+        Convert PIL Image into printer rows the same way as
+        `Printer.printImage()` does, result can be printed later with
+        `Printer.printImageBytes()`. Packed rows take 8 times less memory
+        than grayscale image, so conversion can be done before queueing.
+
+        Arguments:
+        * `img` - your pretty PIL Image.
+        * `resample` - resampling mode of the image, used to automatically
+        rescale image to fit the printer width of `Printer.getRowWidth()`.
+        * `dither` - conversion to black/white mode, same as for
+        `Printer.printImage()`.
+        """
+
+        return self._convertImage(img, resample, dither).tobytes()
+
+    def printImage(self, img: PIL.Image.Image, delay=0.01, resample=PIL.Image.Resampling.NEAREST, dither: str='fs', force_reset: bool=False) -> None:
         """
         Print PIL Image on this printer with automatic internal to-blackwhite
-        conversion.
+        conversion. Image is converted to grayscale, resized and then
+        dithered or thresholded at the middle gray level.
 
         WARNING: In order to prevent the overhead of the printer (and possibly
         loose some data but to limitations of the in-printer buffer) it is
@@ -832,37 +1416,56 @@ class Printer:
         * `delay` - delay between printing each row of the image.
         * `resample` - resampling mode of the image, used to automatically
         rescale image to fit the printer width of `Printer.getRowWidth()`.
+        * `dither` - conversion to black/white mode, `'fs'` (default) for
+        Floyd-Steinberg error diffusion that gives better results on photos,
+        `'bayer'` for ordered dithering with regular pattern or `None` for
+        plain threshold that keeps text and line art sharp.
+        Ignored for '1' mode images of `Printer.getRowWidth()` width, they are
+        printed as is.
+        * `force_reset` - reset printer state even if it was not changed since
+        the last raster print.
         """
 
-        img = img.convert('L')
-        img = PIL.ImageOps.invert(img)
-        img = img.resize((self.getRowWidth(), int(self.getRowWidth() / img.size[0] * img.size[1])), resample)
-        img = img.convert('1')
+        img = self._convertImage(img, resample, dither)
 
-        imgbytes = img.tobytes()
-        self.printImageBytes(imgbytes, delay=delay)
+        # Serialize and send by tiles of 0xff rows, the whole packed image is
+        # never materialized as a single bytes object
+        width, height = img.size
+        for y in range(0, height, 0xff):
+            tile = img.crop((0, y, width, min(y + 0xff, height)))
+            self._printChunk(tile.tobytes(), tile.size[1], delay=delay, force_reset=force_reset)
+            force_reset = False
 
-    def printImageIterator(self, imgiterator: typing.Iterable[PIL.Image.Image], delay: float=0.01):
+    def printImageIterator(self, imgiterator: typing.Iterable[PIL.Image.Image], delay: float=0.01, prefetch: int=0):
         """
         Iterate over iterator and print out each PIL Image that it returns.
 
         Arguments:
         * `rowiterator` - iterator that returns list[bytes].
         * `delay` - delay between printing each row of the image.
+        * `prefetch` - if positive, iterator is consumed in background thread
+        that keeps up to `prefetch` images ready while printer is busy.
         """
 
+        if prefetch > 0:
+            with contextlib.closing(_prefetch(imgiterator, prefetch)) as images:
+                self.printImageIterator(images, delay=delay)
+            return
+
         for img in imgiterator:
             self.printImage(img, delay=delay)
 
     def printQR(self, text: str, delay: float=0.01, resample=PIL.Image.Resampling.NEAREST) -> None:
         """
-        Generate a QR code from specified string and print it.
+        Generate a QR code from specified string and print it. Generated
+        codes are cached, so printing the same text again is faster.
 
         Arguments:
         * `text` - your pretty text.
         * `delay` - delay between printing each row of the image.
-        * `resample` - resampling mode of the image, used to automatically
-        rescale image to fit the printer width of `Printer.getRowWidth()`.
+        * `resample` - ignored, code is generated one pixel per module and
+        always scaled with `NEAREST` so module edges stay sharp. Kept for
+        compatibility.
         """
 
-        self.printImage(qrcode.make(text, border=0), delay=delay, resample=resample)
+        self.printImage(_make_qr(text, 0), delay=delay, resample=PIL.Image.Resampling.NEAREST, dither=None)
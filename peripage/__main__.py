@@ -15,11 +15,115 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+def _introduce(printer, args) -> None:
+    """
+    Ask the printer to introduce itself
+    """
+
+    # print('Hello, my name is Harold..')
+    print(printer.getDeviceFull().decode('ascii'))
+
+
+def _stream(printer, args) -> None:
+    """
+    Print text received from STDIN
+    """
+
+    import sys
+
+    # Read whatever input is available at once, so piped text is printed in
+    # large batches while interactive input is still printed line by line.
+    # Loop ends when input is closed ^d^d
+    stdin = sys.stdin.buffer
+    for chunk in iter(lambda: stdin.read1(4096), b''):
+        printer.printASCII(chunk)
+
+    printer.flushASCII()
+
+
+def _text(printer, args) -> None:
+    """
+    Print text from arguments
+    """
+
+    text = args.text.rstrip()
+
+    if len(text) > 0:
+        printer.printASCII(text)
+        printer.flushASCII()
+
+
+def _image(printer, args) -> None:
+    """
+    Print image, `args.image` is replaced with loaded image or raw printer
+    rows before connecting
+    """
+
+    if isinstance(args.image, bytes):
+        printer.printImageBytes(args.image)
+    else:
+        printer.printImage(args.image, dither=None if args.dither == 'none' else args.dither)
+
+
+def _qr(printer, args) -> None:
+    """
+    Print QR code
+    """
+
+    printer.printQR(args.qr)
+
+
+def _read_pbm(path: str, width: int):
+    """
+    Read rows of raw (P4) PBM image that is exactly `width` pixels wide. Raw
+    PBM rows are packed MSB-first with `1` for black, which matches printer
+    rows, so data is printed as is. Returns `None` for any other file.
+    """
+
+    import re
+
+    with open(path, 'rb') as f:
+        if f.read(2) != b'P4':
+            return None
+        data = f.read()
+
+    # Width and height separated by whitespace and comments, followed by
+    # single whitespace before raster
+    header = re.match(rb'(?:\s|#[^\r\n]*)+(\d+)(?:\s|#[^\r\n]*)+(\d+)\s', data)
+    if header is None or int(header[1]) != width:
+        return None
+
+    size = width // 8 * int(header[2])
+    if len(data) - header.end() < size:
+        return None
+
+    return data[header.end():header.end() + size]
+
+
+# Handler for each of mutually exclusive printing actions, `introduce` does
+# not print and is handled separately
+_HANDLERS = {
+    'stream': _stream,
+    'text': _text,
+    'image': _image,
+    'qr': _qr,
+}
+
+
 def main():
     import argparse
     import sys
     import peripage
-    import PIL.Image
+
+    def u8(value: str) -> int:
+        """
+        Parse integer in range `[0, 255]`
+        """
+
+        value = int(value)
+        if not (0 <= value <= 255):
+            raise argparse.ArgumentTypeError(f'{ value } is not in range [0-255]')
+        return value
 
     parser = argparse.ArgumentParser(description='Print on a Peripage printer via bluetooth')
     parser.add_argument(
@@ -40,11 +144,17 @@ def main():
         '-b', '--break',
         dest='break_size',
         help='Size of the break inserted after printed image or text',
-        choices=range(256),
         metavar='[0-255]',
-        type=int,
+        type=u8,
         default=0
     )
+    parser.add_argument(
+        '-d', '--dither',
+        help='Conversion of printed image to black/white: Floyd-Steinberg dithering, ordered dithering or plain threshold',
+        choices=['fs', 'bayer', 'none'],
+        type=str,
+        default='fs'
+    )
     parser.add_argument(
         '-p', '--printer',
         help='Printer model selection',
@@ -61,7 +171,7 @@ def main():
     )
     group.add_argument(
         '-s', '--stream',
-        help='Print text received from STDIN, line by line. Text must be ASCII-safe and will be filtered for invalid characters',
+        help='Print text received from STDIN as it arrives, incomplete line is printed when it is completed or input ends. Text must be ASCII-safe and will be filtered for invalid characters',
         action='store_true'
     )
     group.add_argument(
@@ -82,91 +192,60 @@ def main():
 
     args = parser.parse_args()
 
-    # Open connection
-    printer = peripage.Printer(args.mac, peripage.PrinterType[args.printer])
-    printer.connect()
-    printer.reset()
-
-    # Act based on args
-    if 'introduce' in args and args.introduce:
-
-        # print('Hello, my name is Harold..')
-        print(printer.getDeviceFull().decode('ascii'))
-        printer.disconnect()
-        sys.exit(0)
-
-    elif 'stream' in args and args.stream:
-
-        printer.setConcentration(args.concentration)
-
-        while True:
-            try:
-                line = input().rstrip()
-
-                printer.printlnASCII(line)
-
-            except EOFError:
-                # Input closed ^d^d
-                break
-
-        if args.break_size > 0:
-            printer.printBreak(args.break_size)
-
-        printer.disconnect()
-
-        sys.exit(0)
+    # Resolve printer model once
+    ptype = peripage.PrinterType[args.printer]
+    printer = peripage.Printer(args.mac, ptype)
 
-    elif 'text' in args and args.text is not None:
+    # Exactly one action is set, flags default to False, values to None
+    action = next(name for name in ('introduce', *_HANDLERS) if getattr(args, name) not in (None, False))
 
-        printer.setConcentration(args.concentration)
-
-        text = args.text.rstrip()
-
-        if len(text) > 0:
-            printer.printASCII(text)
-            printer.flushASCII()
-
-        if args.break_size > 0:
-            printer.printBreak(args.break_size)
+    # Load image before connecting, so invalid input does not touch printer
+    if action == 'image':
 
-        printer.disconnect()
+        import PIL.Image
 
-        sys.exit(0)
-
-    elif 'image' in args and args.image is not None:
+        try:
+            # Printer-native image is printed as is, without decoding
+            img = _read_pbm(args.image, ptype.spec.row_width)
 
-        printer.setConcentration(args.concentration)
+            if img is None:
+                img = PIL.Image.open(args.image)
 
-        try:
-            img = PIL.Image.open(args.image)
-        except:
-            print(f'Failed to open image { args.image }')
+                # Let JPEG decoder downscale by power of two while decoding,
+                # does nothing for other formats
+                width, height = img.size
+                if width > ptype.spec.row_width:
+                    img.draft('L', (ptype.spec.row_width, height * ptype.spec.row_width // width))
 
-        printer.printImage(img)
+                img.load()
+        except OSError as e:
+            print(f'Failed to open image { args.image }: { e }')
+            sys.exit(2)
 
-        if args.break_size > 0:
-            printer.printBreak(args.break_size)
+        # Shrink large images by integer box reduction to about the printer
+        # width, so the final resize inside printImage() is cheap
+        if not isinstance(img, bytes):
+            img = img.convert('L')
+            ratio = img.size[0] // ptype.spec.row_width
+            if ratio > 1:
+                img = img.reduce(ratio)
 
-        printer.disconnect()
+        args.image = img
 
-        sys.exit(0)
+    # Connect and reset, printer is disconnected on exit
+    with printer:
 
-    elif 'qr' in args and args.qr is not None:
+        if action == 'introduce':
+            _introduce(printer, args)
+            return
 
         printer.setConcentration(args.concentration)
 
-        printer.printQR(args.qr)
+        _HANDLERS[action](printer, args)
 
         if args.break_size > 0:
             printer.printBreak(args.break_size)
 
-        printer.disconnect()
-
-        sys.exit(0)
-
-    else:
-
-        print('How did you get there?')
 
 if __name__ == '__main__':
     main()
@@ -9,6 +9,7 @@
 
 
 import aiohttp
+import asyncio
 import io
 import os
 import aiohttp.web
@@ -17,6 +18,7 @@ import peripage
 import atexit
 import PIL
 import sys
+import tempfile
 
 from dateutil import tz
 from datetime import datetime
@@ -39,6 +41,9 @@ service: print_service.PrintService = None
 app: aiohttp.web.Application = None
 file = None
 
+# Timezone of the logged dates, resolved once
+timezone = tz.gettz(TIMEZONE)
+
 
 # Utils
 def log(*args):
@@ -49,16 +54,57 @@ def log(*args):
     file.write('\n')
     file.flush()
 
-def print_break(timestamp, date, ip, proxy_ip):
+def save_atomic(path, write):
+    """
+    Write file with `write(temp_path)` and move it in place, so partially
+    written file never appears under `path`
+    """
+
+    temp_path = f'{path}.tmp'
+    write(temp_path)
+    os.replace(temp_path, path)
+
+def write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+def load_image(buf):
+    """
+    Decode whole image from the start of file object
+    """
+
+    buf.seek(0)
+    img = PIL.Image.open(buf)
+    img.load()
+    return img
+
+async def run_blocking(func, *args):
+    """
+    Run blocking call in thread pool without stalling other requests
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def print_break_size(request: aiohttp.web.Request):
+    """
+    Size of the page break requested after printed data, 0 for no break
+    """
+
+    if (request.query.get('print_break', None) == 'true') or (request.query.get('print_break', None) == '1'):
+        return BREAK_SIZE
+    return 0
+
+def log_done(kind, break_size, timestamp, date, ip, proxy_ip):
     """
-    Simple page break of given size
+    Completion callback of the queued print task
     """
 
-    def wrap_print_break(p: peripage.Printer):
-        p.printBreak(BREAK_SIZE)
-        log(ip, '/', proxy_ip, '#', date, timestamp, 'done', 'BREAK')
+    def done():
+        log(ip, '/', proxy_ip, '#', date, timestamp, 'done', kind)
+        if break_size > 0:
+            log(ip, '/', proxy_ip, '#', date, timestamp, 'done', 'BREAK')
 
-    service.add_print_handler(wrap_print_break)
+    return done
 
 
 # Handlers
@@ -78,12 +124,16 @@ async def post_print_ascii(request: aiohttp.web.Request):
             'message': 'missing request body'
         })
 
+    # Client and proxy addresses for logging, print tasks capture these
+    # instead of the whole request
+    ip = request.remote
+    proxy_ip = request.headers.get('X-Forwarded-For', 'None')
+
     # Clear, post and return length
     text = await request.text()
 
     # Additinally process string
-    text.replace('\t', '    ')
-    ascii_text = ''.join([i for i in text if (31 < ord(i) or ord(i) == 10) and ord(i) < 127]).strip()
+    ascii_text = peripage.Printer.filter_ascii(text.replace('\t', '    ')).strip()
 
     if len(ascii_text) == 0:
         return aiohttp.web.json_response({
@@ -91,40 +141,34 @@ async def post_print_ascii(request: aiohttp.web.Request):
             'message': 'empty ascii string'
         })
 
-    date = datetime.now(tz.gettz(TIMEZONE))
+    date = datetime.now(timezone)
     timestamp = round(date.timestamp() * 1000)
     date = date.strftime("%d.%m.%Y %H:%M:%S.%f")
 
     # Log
-    log(request.remote, '/', request.headers.get('X-Forwarded-For', 'None'), '#', date, timestamp, '--->', 'ASCII')
+    log(ip, '/', proxy_ip, '#', date, timestamp, '--->', 'ASCII')
 
     # Save data
     if RECEIVE_DIRECTORY is not None:
-        with open(f'{RECEIVE_DIRECTORY}/{timestamp}_ascii.txt', 'w') as f:
-            f.write(ascii_text)
+        await run_blocking(save_atomic, f'{RECEIVE_DIRECTORY}/{timestamp}_ascii.txt', lambda path: write_text(path, ascii_text))
 
     # Decorate string
     print_text = ascii_text
     if (request.query.get('print_date', None) == 'true') or (request.query.get('print_date', None) == '1'):
         print_text = f'{date}\n{print_text}'
 
+    # Text is already filtered, encode it once for the printer
+    print_bytes = print_text.encode('ascii')
+
     # Get concentration
     try:
         concenttration = min(2, max(0, int(request.query.get('print_concentration', 0))))
     except:
         concenttration = 0
 
-    # Submit image printing task
-    def wrap_print_ascii(p: peripage.Printer):
-        p.setConcentration(concenttration)
-        p.printASCII(ascii_text)
-        p.flushASCII()
-        log(request.remote, '/', request.headers.get('X-Forwarded-For', 'None'), '#', date, timestamp, 'done', 'ASCII')
-
-    service.add_print_handler(wrap_print_ascii)
-
-    if (request.query.get('print_break', None) == 'true') or (request.query.get('print_break', None) == '1'):
-        print_break(timestamp, date, request.remote, request.headers.get('X-Forwarded-For', 'None'))
+    # Submit text printing task
+    break_size = print_break_size(request)
+    service.add_print_ascii(print_bytes, concenttration, break_size, flush=True, done=log_done('ASCII', break_size, timestamp, date, ip, proxy_ip))
 
     return aiohttp.web.json_response({
         'status': 'result',
@@ -146,8 +190,18 @@ async def post_print_image(request: aiohttp.web.Request):
             'message': 'missing request body'
         })
 
-    post = post = await request.post()
-    image = post.get('image')
+    # Client and proxy addresses for logging, print tasks capture these
+    # instead of the whole request
+    ip = request.remote
+    proxy_ip = request.headers.get('X-Forwarded-For', 'None')
+
+    # Read multipart fields until image, upload is not buffered by aiohttp
+    image = None
+    if request.content_type == 'multipart/form-data':
+        reader = await request.multipart()
+        image = await reader.next()
+        while image is not None and image.name != 'image':
+            image = await reader.next()
 
     if not image:
         return aiohttp.web.json_response({
@@ -156,14 +210,40 @@ async def post_print_image(request: aiohttp.web.Request):
         })
 
     try:
-        img_content = image.file.read()
-        buf = io.BytesIO(img_content)
-        img = PIL.Image.open(buf)
-
-        date = datetime.now(tz.gettz(TIMEZONE))
+        date = datetime.now(timezone)
         timestamp = round(date.timestamp() * 1000)
         date = date.strftime("%d.%m.%Y %H:%M:%S.%f")
 
+        # Stream upload by chunks into the received file, or into memory if
+        # received files are not stored. Uploads received in the same
+        # millisecond get distinct files. Decoding runs off the event loop
+        upload_path = None
+        if RECEIVE_DIRECTORY is not None:
+            buf = tempfile.NamedTemporaryFile(dir=RECEIVE_DIRECTORY, prefix=f'{timestamp}_', suffix='_upload', delete=False)
+            upload_path = buf.name
+        else:
+            buf = io.BytesIO()
+
+        img_length = 0
+        try:
+            with buf:
+                while True:
+                    chunk = await image.read_chunk(64 * 1024)
+                    if not chunk:
+                        break
+
+                    img_length += len(chunk)
+                    if img_length > MAX_FILE_SIZE:
+                        raise ValueError('request image is too large')
+
+                    buf.write(chunk)
+
+                img = await run_blocking(load_image, buf)
+        except:
+            if upload_path is not None:
+                os.remove(upload_path)
+            raise
+
         if not img:
             return aiohttp.web.json_response({
                 'status': 'error',
@@ -171,11 +251,17 @@ async def post_print_image(request: aiohttp.web.Request):
             })
 
         # Log
-        log(request.remote, '/', request.headers.get('X-Forwarded-For', 'None'), '#', date, timestamp, '--->', 'Image')
+        log(ip, '/', proxy_ip, '#', date, timestamp, '--->', 'Image')
 
-        # Save data
+        # Save data next to the unique upload name, PNG upload is kept as is
+        # without re-encoding
         if RECEIVE_DIRECTORY is not None:
-            img.save(f'{RECEIVE_DIRECTORY}/{timestamp}_image.png', 'PNG')
+            image_path = upload_path[:-len('_upload')] + '_image.png'
+            if img.format == 'PNG':
+                os.replace(upload_path, image_path)
+            else:
+                await run_blocking(save_atomic, image_path, lambda path: img.save(path, 'PNG'))
+                os.remove(upload_path)
 
         # Get concentration
         try:
@@ -183,22 +269,18 @@ async def post_print_image(request: aiohttp.web.Request):
         except:
             concenttration = 0
 
-        # Submit image printing task
-        def wrap_print_image(p: peripage.Printer):
-            p.setConcentration(concenttration)
-            p.printImage(img)
-            log(request.remote, '/', request.headers.get('X-Forwarded-For', 'None'), '#', date, timestamp, 'done', 'Image')
-
-        service.add_print_handler(wrap_print_image)
+        # Convert to packed printer rows before queueing, so queued task does
+        # not hold the decoded image
+        img_bytes = await run_blocking(service.printer.encodeImage, img)
 
-        # Add page break
-        if (request.query.get('print_break', None) == 'true') or (request.query.get('print_break', None) == '1'):
-            print_break(timestamp, date, request.remote, request.headers.get('X-Forwarded-For', 'None'))
+        # Submit image printing task
+        break_size = print_break_size(request)
+        service.add_print_image(img_bytes, concenttration, break_size, done=log_done('Image', break_size, timestamp, date, ip, proxy_ip))
 
         # Return size of payload
         return aiohttp.web.json_response({
             'status': 'result',
-            'length': len(img_content)
+            'length': img_length
         })
 
     except:
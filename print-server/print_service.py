@@ -5,56 +5,94 @@
 # Copyright (c) 2022 bitrate16
 
 import time
+import logging
 import threading
+import collections
 import PIL
 
 import peripage
 
 
+logger = logging.getLogger(__name__)
+
+
+# Queued print task, `kind` is one of 'ascii', 'image', 'break', 'flush' or
+# 'concentration', `data` is text, image or packed image rows to print, `done`
+# is called without arguments after the task is printed
+Job = collections.namedtuple('Job', ('kind', 'data', 'concentration', 'break_size', 'flush', 'done'), defaults=(None,))
+
+# Largest break printer accepts in single command
+MAX_BREAK_SIZE = 0xff
+
+
 class Repeat():
 	"""
-	Interval-based code execution
+	Interval-based code execution. Handler may return number of seconds to
+	wait before the next call instead of the default interval.
 	"""
 
 	def __init__(self, interval: float, handler):
 		self.interval = interval
 		self.running = False
-		self.should_stop = True
 		self.thread = None
 		self.handler = handler
 
+		# Interrupts waiting for the next interval
+		self.wakeup = threading.Event()
+
+		# Set to stop the loop, also interrupts waiting
+		self.stop_event = threading.Event()
+
 	def start(self):
 		if self.running:
 			return False
 		else:
 			def handler():
-				self.running = True
-
-				while not self.should_stop:
+				while not self.stop_event.is_set():
+					self.wakeup.clear()
+					interval = None
 					try:
-						self.handler()
-					except:
+						interval = self.handler()
+					except Exception:
 						# XXX: Important: we are ignoring this exception
-						pass
-					time.sleep(self.interval)
+						logger.debug('Repeat handler failed', exc_info=True)
+					self.wakeup.wait(self.interval if interval is None else interval)
 
 				self.running = False
 
-			self.should_stop = False
-			self.thread = threading.Thread(target=handler).start()
+			# Marked before the thread starts, so repeated start() can not
+			# spawn second loop. Daemon thread does not block process exit
+			self.running = True
+			self.stop_event.clear()
+			self.thread = threading.Thread(target=handler, daemon=True)
+			try:
+				self.thread.start()
+			except Exception:
+				self.running = False
+				raise
 			return True
 
 	def stop(self):
-		if not self.running:
-			return False
-		else:
-			self.should_stop = True
+		# Safe to call any number of times and before start()
+		self.stop_event.set()
+		self.wakeup.set()
+
+		# Let current handler call finish, unless stopped from it
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join(self.interval * 2)
+
+	def wake(self):
+		"""
+		Run handler without waiting for the rest of the interval
+		"""
+
+		self.wakeup.set()
 
 	def set_handler(self, handler):
 		self.handler = handler
 
 	def is_running(self):
-		return self.running
+		return self.running and not self.stop_event.is_set()
 
 
 class PrintService:
@@ -62,8 +100,9 @@ class PrintService:
 	This printer task autimatically handler print tasks from internal queue and
 	maintains printer connected state.
 
-	Printer processes events in another thread by proocessing single event per
-	event_interval.
+	Printer processes events in another thread until the queue is empty, idle
+	queue is checked every event_interval. Adding a new event wakes the service
+	up immediately.
 
 	If printer disconnects, this service will automatically reconnect it after
 	event_interval and print in the same time slot. If reconnect attempts fail,
@@ -80,16 +119,22 @@ class PrintService:
 		# Printer event check interval, seconds
 		self.event_interval = event_interval
 
-		# Last printer ping timestamp, seconds
+		# Last printer ping or task timestamp, `time.monotonic()` seconds
 		self.last_ping_timestamp = 0
 
+		# Time of the next keep-alive ping, `last_ping_timestamp + ping_interval`
+		self._ping_deadline = ping_interval
+
+		# Windows workaround is pending for the fresh connection
+		self._listen_pending = False
+
 		# Interval to wait after printer cconnection established
 		self.startup_interval = startup_interval
 
 		# Time between reconnect attempts
 		self.offline_interval = offline_interval
 
-		# interval between ping and data sending
+		# interval between keep-alive ping and data sending
 		self.guard_ping_interval = guard_ping_interval
 
 		# Serive task loop
@@ -98,12 +143,22 @@ class PrintService:
 		# Instance of printer
 		self.printer: peripage.Printer = None
 
-		# Event queue
-		self.events = []
+		# Event queue, appended by producers and popped from the left by the
+		# service thread, both are atomic for deque
+		self.events = collections.deque()
+
+		# Guards replacing queued tasks against popping them by the service
+		self.events_lock = threading.Lock()
 
 		# Indicate service failture
 		self.service_failture = True
 
+		# Concentration last sent to the printer, None if unknown
+		self._last_concentration: int = None
+
+		# Battery level returned by the last keep-alive ping
+		self.last_battery: int = None
+
 	def start(self, printer_mac: str, printer_type: peripage.PrinterType, timeout: float = 1.0, concentration: int = 1):
 		"""
 		Perform startup oof the service without check for previous instance running.
@@ -117,41 +172,66 @@ class PrintService:
 			initial_failture = True
 			while self.service.is_running():
 				try:
-					if not self.printer.isConnected():
-						raise RuntimeError('not connected')
-
-					# Windows workaround
-					try:
-						self.printer.sock.listen()
-					except:
-						pass
-
-					if not self.printer.isConnected():
-						raise RuntimeError('not connected')
-
-					# If time is over, perform keep-alive procedure
-					if time.time() > (self.last_ping_timestamp + self.ping_interval):
-						str(self.printer.getDeviceBattery())
-						self.last_ping_timestamp = time.time()
+					now = time.monotonic()
+					ping_due = now > self._ping_deadline
+
+					# Socket is probed only before talking to the printer, idle
+					# ticks rely on the tracked state and the keep-alive ping
+					probe = len(self.events) != 0 or ping_due
+
+					if not self.printer.isConnected(check=probe):
+						raise ConnectionError('not connected')
+
+					# Windows workaround, once per connection
+					if probe and self._listen_pending:
+						self._listen_pending = False
+						try:
+							self.printer.sock.listen()
+						except Exception:
+							pass
+
+					# If time is over, perform keep-alive procedure. Printed
+					# tasks count as traffic too, so busy link is not pinged
+					if ping_due:
+						self.last_battery = self.printer.getDeviceBattery()
+						self._set_ping_timestamp(now)
 
 					# Execute task handler
-					# Task will be deleted only after correct execution without exceptions
-					if len(self.events):
+					# Task will be deleted only after correct execution or if
+					# it failed by itself, connection errors keep it for retry
+					with self.events_lock:
+						job = self.events[0] if len(self.events) else None
 
-						if self.guard_ping_interval is not None:
-							str(self.printer.getDeviceBattery())
-							self.last_ping_timestamp = time.time()
+					if job is not None:
 
+						# Give printer time to wake up after idle
+						if ping_due and self.guard_ping_interval is not None:
 							time.sleep(self.guard_ping_interval)
 
-						self.events[0](self.printer)
-						self.events.pop(0)
-
-					# Return on success
-					return
-
-				except:
+						# Acknowledgements are read once after the whole task
+						try:
+							with self.printer.pipeline():
+								self._dispatch(job)
+						except OSError:
+							raise
+						except Exception:
+							# Broken task would fail after every reconnect
+							logger.exception('Print task failed and was dropped')
+
+						# Queue may be cleared while task is running
+						with self.events_lock:
+							if len(self.events) and self.events[0] is job:
+								self.events.popleft()
+						self._set_ping_timestamp(time.monotonic())
+
+					# Keep draining the queue, once it is empty sleep until the
+					# next keep-alive ping unless woken up by a new task
+					if len(self.events) == 0:
+						return max(0, self._ping_deadline - time.monotonic())
+
+				except Exception:
 					# Connection error, reinitialize connection
+					logger.debug('Printer connection failed, reconnecting', exc_info=True)
 					self.service_failture = True
 
 					# Wait for offline_interval before reconnects
@@ -159,30 +239,32 @@ class PrintService:
 						time.sleep(self.offline_interval)
 					initial_failture = False
 
-					# Disconnect
+					# Disconnect, socket is closed even if already marked lost
 					try:
-						if self.printer.isConnected():
-							self.printer.disconnect()
-					except:
+						self.printer.disconnect()
+					except OSError:
 						pass
 
 					# Connect
 					try:
+						self._last_concentration = None
 						self.printer.connect()
 						self.printer.reset()
 						self.printer.setConcentration(self.concentration)
+						self._last_concentration = self.concentration
 
 						time.sleep(self.startup_interval)
 
-						self.last_ping_timestamp = time.time()
+						self._set_ping_timestamp(time.monotonic())
+						self._listen_pending = True
 						self.service_failture = False
-					except:
+					except OSError:
 						pass
 
 		self.concentration = concentration
 		self.printer = peripage.Printer(printer_mac, printer_type, timeout)
-		self.last_ping_timestamp = time.time()
-		self.events = []
+		self._set_ping_timestamp(time.monotonic())
+		self.events = collections.deque()
 		self.service = Repeat(self.event_interval, service_handler)
 		self.service.start()
 
@@ -190,12 +272,86 @@ class PrintService:
 		try:
 			self.service.stop()
 			self.printer.disconnect()
-		except:
+		except Exception:
 			pass
 
+	def _set_ping_timestamp(self, timestamp: float):
+		"""
+		Record printer traffic time and move the next keep-alive ping after it
+		"""
+
+		self.last_ping_timestamp = timestamp
+		self._ping_deadline = timestamp + self.ping_interval
+
+	def _dispatch(self, job):
+		"""
+		Execute queued `Job` or user handler on the printer
+		"""
+
+		if not isinstance(job, Job):
+			# Handler may change concentration by itself
+			self._last_concentration = None
+			job(self.printer)
+			return
+
+		# Concentration is kept by printer, skip repeating the same value
+		if job.concentration is not None and job.concentration != self._last_concentration:
+			self.printer.setConcentration(job.concentration)
+			self._last_concentration = job.concentration
+
+		if job.kind == 'ascii':
+			self.printer.printASCII(job.data)
+		elif job.kind == 'image':
+			if isinstance(job.data, bytes):
+				self.printer.printImageBytes(job.data)
+			else:
+				self.printer.printImage(job.data)
+
+		if job.flush:
+			self.printer.flushASCII()
+
+		if job.break_size is not None and job.break_size > 0:
+			self.printer.printBreak(job.break_size)
+
+		if job.done is not None:
+			job.done()
+
 	def is_service_failture(self):
 		return self.service_failture
 
+	def get_last_battery(self):
+		"""
+		Returns battery level from the last keep-alive ping without asking the
+		printer, None if printer was not pinged yet
+		"""
+
+		return self.last_battery
+
+	def _enqueue(self, print_handler):
+		"""
+		Add task to the queue and wake up the service to run it immediately
+		"""
+
+		self.events.append(print_handler)
+		if self.service is not None:
+			self.service.wake()
+
+	def _enqueue_break(self, break_size: int):
+		"""
+		Add break to the queue. Break is printed last by every `Job`, so it is
+		merged into the last queued job if combined size fits single command.
+		Running job is never changed.
+		"""
+
+		with self.events_lock:
+			if len(self.events) > 1:
+				last = self.events[-1]
+				if isinstance(last, Job) and (last.break_size or 0) + break_size <= MAX_BREAK_SIZE:
+					self.events[-1] = last._replace(break_size=(last.break_size or 0) + break_size)
+					return
+
+		self._enqueue(Job('break', None, None, break_size, False))
+
 	def add_print_handler(self, print_handler):
 		"""
 		Adds event handler to the queue. THis handler will be executed with single
@@ -208,12 +364,12 @@ class PrintService:
 		"""
 
 		try:
-			self.events.append(print_handler)
+			self._enqueue(print_handler)
 			return True
-		except:
+		except Exception:
 			return False
 
-	def add_print_ascii(self, ascii_text: str, concentration: int=None, break_size: int=0, /, flush: bool = False):
+	def add_print_ascii(self, ascii_text: str, concentration: int=None, break_size: int=0, /, flush: bool = False, done=None):
 		"""
 		Adds simple print ASCII event to queue, additionally flushes output
 		buffer.
@@ -230,6 +386,8 @@ class PrintService:
 		`flush` allows force flushing ASCII buffer. Refers to
 		`peripage.Printer.flushASCII()`.
 
+		`done` is called without arguments after the text is printed.
+
 
 		Example:
 		```
@@ -237,29 +395,18 @@ class PrintService:
 		```
 		"""
 
-		def wrap_print(printer: peripage.Printer):
-			if concentration is not None:
-				printer.setConcentration(concentration)
-
-			printer.printASCII(ascii_text)
-
-			if flush:
-				printer.flushASCII()
-
-			if break_size is not None and break_size > 0:
-				printer.printBreak(break_size)
-
 		try:
-			self.events.append(wrap_print)
+			self._enqueue(Job('ascii', ascii_text, concentration, break_size, flush, done))
 			return True
-		except:
+		except Exception:
 			return False
 
-	def add_print_image(self, image: PIL.Image, concentration: int=None, break_size: int=0):
+	def add_print_image(self, image: PIL.Image, concentration: int=None, break_size: int=0, done=None):
 		"""
 		Adds simple print Image event to queue.
 
-		`image` defines the input image to be printed.
+		`image` defines the input image to be printed, or `bytes` of rows
+		packed with `peripage.Printer.encodeImage()`.
 
 		`concentration` defines the concentration value from range [0, 1, 2].
 		Set to None to ignore.
@@ -268,6 +415,8 @@ class PrintService:
 		`peripage.Printer.printBreak()` for value limitations. Set to None or 0 to
 		ignore.
 
+		`done` is called without arguments after the image is printed.
+
 
 		Example:
 		```
@@ -275,19 +424,10 @@ class PrintService:
 		```
 		"""
 
-		def wrap_print(printer: peripage.Printer):
-			if concentration is not None:
-				printer.setConcentration(concentration)
-
-			printer.printImage(image)
-
-			if break_size is not None and break_size > 0:
-				printer.printBreak(break_size)
-
 		try:
-			self.events.append(wrap_print)
+			self._enqueue(Job('image', image, concentration, break_size, False, done))
 			return True
-		except:
+		except Exception:
 			return False
 
 	def add_print_break(self, break_size: int=0):
@@ -307,9 +447,9 @@ class PrintService:
 
 		if break_size is not None and break_size > 0:
 			try:
-				self.events.append(lambda p: p.printBreak(break_size))
+				self._enqueue_break(break_size)
 				return True
-			except:
+			except Exception:
 				return False
 		return False
 
@@ -325,9 +465,9 @@ class PrintService:
 		"""
 
 		try:
-			self.events.append(lambda p: p.flushASCII())
+			self._enqueue(Job('flush', None, None, 0, True))
 			return True
-		except:
+		except Exception:
 			return False
 
 	def add_print_concentration(self, concentration: int=None):
@@ -346,9 +486,9 @@ class PrintService:
 
 		if concentration is not None:
 			try:
-				self.events.append(lambda p: p.setConcentration(concentration))
+				self._enqueue(Job('concentration', None, concentration, 0, False))
 				return True
-			except:
+			except Exception:
 				return False
 		return False
 
@@ -357,7 +497,7 @@ class PrintService:
 		Remove all tasks from queue
 		"""
 
-		if self.events:
+		with self.events_lock:
 			self.events.clear()
 
 	def get_task_count(self):
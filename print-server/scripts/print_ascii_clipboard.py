@@ -7,11 +7,17 @@ BREAK         = 1 # Enable/disable
 CONCENTRATION = 2 # Value (0-2)
 SECRET_KEY    = '1234567890'
 
+# Keep-alive connection shared by all requests of the script
+session = requests.Session()
+
+# Keep printable ASCII and newlines only
+ASCII_UNSAFE = bytes(b for b in range(256) if not (31 < b < 127 or b == 10))
+
 s = pyperclip.paste().strip().replace('\t', '    ')
-s = ''.join([i for i in s if (31 < ord(i) or ord(i) == 10) and ord(i) < 127])
+s = s.encode('ascii', 'ignore').translate(None, ASCII_UNSAFE).decode('ascii')
 print(s)
 
-r = requests.post(
+r = session.post(
 	url=f'{SERVER_ADDR}/print_ascii?print_break={BREAK}&print_concentration={CONCENTRATION}&secret={SECRET_KEY}',
 	data=s
 )
@@ -11,6 +11,9 @@ BREAK         = 1 # Enable/disable
 CONCENTRATION = 2 # Value (0-2)
 SECRET_KEY    = '1234567890'
 
+# Keep-alive connection shared by all requests of the script
+session = requests.Session()
+
 # Detect type: list[str] or image
 
 im = PIL.ImageGrab.grabclipboard()
@@ -22,7 +25,7 @@ if isinstance(im, list):
 		raise RuntimeError('Invalid file type')
 
 	try:
-		r = requests.post(
+		r = session.post(
 			url=f'{SERVER_ADDR}/print_image?print_break={BREAK}&print_concentration={CONCENTRATION}&secret={SECRET_KEY}',
 			files={
 				'image': open(im, 'rb')
@@ -38,7 +41,7 @@ else:
 	im.save(temp_name, 'PNG')
 
 	try:
-		r = requests.post(
+		r = session.post(
 			url=f'{SERVER_ADDR}/print_image?print_break={BREAK}&print_concentration={CONCENTRATION}&secret={SECRET_KEY}',
 			files={
 				'image': open(temp_name, 'rb')
@@ -6,7 +6,10 @@ BREAK         = 1 # Enable/disable
 CONCENTRATION = 2 # Value (0-2)
 SECRET_KEY    = '1234567890'
 
-r = requests.post(
+# Keep-alive connection shared by all requests of the script
+session = requests.Session()
+
+r = session.post(
 	url=f'{SERVER_ADDR}/print_image?print_break={BREAK}&print_concentration={CONCENTRATION}&secret={SECRET_KEY}',
 	files={
 		'image': open(sys.argv[1], 'rb')